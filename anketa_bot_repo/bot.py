@@ -1,19 +1,33 @@
 import asyncio
+import html
 import os
-from dataclasses import dataclass
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 
 import aiosqlite
 import gspread
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import Command, CommandStart
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
+    BufferedInputFile,
+    FSInputFile,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
     KeyboardButton,
     Message,
     ReplyKeyboardMarkup,
@@ -37,7 +51,24 @@ ADMIN_IDS = set(
     if x.strip().isdigit()
 )
 
+_slow_callback_ms = (os.getenv("SLOW_CALLBACK_MS", "") or "100").strip()
+SLOW_CALLBACK_SECONDS = int(_slow_callback_ms) / 1000 if _slow_callback_ms.isdigit() else 0.1
+ASYNCIO_DEBUG = (os.getenv("ASYNCIO_DEBUG", "") or "").strip() == "1"
+
 DB_PATH = "bot.db"
+BROADCAST_MEDIA_DIR = Path(os.getenv("BROADCAST_MEDIA_DIR", "") or "media").resolve()
+
+BROADCAST_DELAY = 0.035
+ALBUM_WAIT = 1.0
+ALBUM_DONE_TTL = 600
+PHOTO_EXTS = {".jpg", ".jpeg", ".png", ".webp"}
+VIDEO_EXTS = {".mp4", ".mov", ".m4v"}
+
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 50
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -290,6 +321,19 @@ async def init_db() -> None:
             )
             """
         )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS media_cache (
+                path TEXT,
+                kind TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                file_id TEXT,
+                uploaded_at TEXT,
+                PRIMARY KEY (path)
+            )
+            """
+        )
         await db.commit()
 
 
@@ -332,6 +376,35 @@ async def all_user_ids() -> List[int]:
     return [int(r[0]) for r in rows]
 
 
+async def get_cached_file_id(path: str, size: int, mtime_ns: int) -> Optional[Tuple[str, str]]:
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(
+            "SELECT kind, file_id FROM media_cache WHERE path=? AND size=? AND mtime_ns=?",
+            (path, size, mtime_ns),
+        ) as cur:
+            row = await cur.fetchone()
+    return (row[0], row[1]) if row else None
+
+
+async def cache_file_id(path: str, kind: str, size: int, mtime_ns: int, file_id: str) -> None:
+    now = datetime.now(timezone.utc).isoformat()
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            """
+            INSERT INTO media_cache(path, kind, size, mtime_ns, file_id, uploaded_at)
+            VALUES(?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                kind=excluded.kind,
+                size=excluded.size,
+                mtime_ns=excluded.mtime_ns,
+                file_id=excluded.file_id,
+                uploaded_at=excluded.uploaded_at
+            """,
+            (path, kind, size, mtime_ns, file_id, now),
+        )
+        await db.commit()
+
+
 # -----------------------------
 # Хелперы
 # -----------------------------
@@ -354,6 +427,263 @@ def make_headers(form_key: str) -> List[str]:
     return meta_headers() + questions
 
 
+# -----------------------------
+# Профилирование
+# -----------------------------
+@dataclass
+class LoopWatchdog:
+    """Сообщает о блокировках event loop со стеком заблокировавшего кода."""
+
+    threshold: float
+    _loop_thread: int = field(init=False, default=0)
+    _last_beat: float = field(init=False, default=0.0)
+    _reported: bool = field(init=False, default=False)
+    _stop: threading.Event = field(init=False, default_factory=threading.Event)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        # Встроенный лог asyncio ("Executing ... took N seconds") работает
+        # только в debug-режиме, поэтому сам стек снимаем из отдельного потока.
+        loop.slow_callback_duration = self.threshold
+        if ASYNCIO_DEBUG:
+            loop.set_debug(True)
+
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        loop.create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        print(f"✓ Контроль блокировок event loop: порог {self.threshold * 1000:.0f} мс")
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    async def _heartbeat(self) -> None:
+        while not self._stop.is_set():
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 2)
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            lag = time.monotonic() - self._last_beat - self.threshold / 2
+            if lag < self.threshold:
+                self._reported = False
+                continue
+            if self._reported:
+                continue
+
+            self._reported = True
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+            del frame
+            print(f"⚠ Event loop заблокирован уже {lag:.3f} с:\n{stack}")
+
+
+def frame_stack(frame) -> str:
+    parts: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def sample_thread(thread_id: int, seconds: float, interval: float) -> Counter:
+    """Сэмплирует стек потока thread_id; ключи в формате folded stacks."""
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[frame_stack(frame)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+def format_folded_stacks(stacks: Counter) -> str:
+    # Формат совместим с flamegraph.pl и speedscope.
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def profile_summary(stacks: Counter, seconds: int, limit: int = 10) -> str:
+    total = sum(stacks.values())
+    leaves: Counter = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+
+    lines = [f"🔬 <b>Профиль за {seconds} с</b>, сэмплов: {total}", ""]
+    for leaf, count in leaves.most_common(limit):
+        lines.append(f"{count * 100 / total:5.1f}% {html.escape(leaf)}")
+
+    # Режем по строкам: обрезанный тег или сущность Telegram не примет.
+    while len(lines) > 1 and len("\n".join(lines)) > 1024:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def tracemalloc_report(window: Optional[int], limit: int = TRACEMALLOC_TOP) -> str:
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        )
+    )
+    stats = snapshot.statistics("traceback")
+    total = sum(stat.size for stat in stats)
+
+    if window is None:
+        scope = "с момента запуска tracemalloc"
+    else:
+        scope = f"за окно {window} с"
+    lines = [f"Живые выделения {scope}: {total / 1024:.1f} KiB, мест: {len(stats)}", ""]
+    for i, stat in enumerate(stats[:limit], 1):
+        lines.append(f"#{i}: {stat.size / 1024:.1f} KiB в {stat.count} блоках")
+        lines.extend(stat.traceback.format())
+        lines.append("")
+    return "\n".join(lines)
+
+
+_profile_lock = asyncio.Lock()
+_watchdog: Optional[LoopWatchdog] = None
+
+
+# -----------------------------
+# Рассылка
+# -----------------------------
+InputMedia = Union[InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio]
+
+INPUT_MEDIA: Dict[str, type] = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+
+@dataclass
+class BroadcastPayload:
+    """Сообщение рассылки, собранное один раз на всю кампанию."""
+
+    kind: str
+    text: str = ""
+    file_id: Optional[str] = None
+    media: List[InputMedia] = field(default_factory=list)
+
+    @property
+    def weight(self) -> int:
+        # Альбом расходует лимит Telegram как несколько сообщений.
+        return max(1, len(self.media))
+
+    async def send(self, bot: Bot, chat_id: int) -> None:
+        if self.kind == "album":
+            await bot.send_media_group(chat_id=chat_id, media=self.media)
+        elif self.kind == "text":
+            await bot.send_message(chat_id=chat_id, text=self.text)
+        else:
+            send = getattr(bot, f"send_{self.kind}")
+            await send(chat_id=chat_id, caption=self.text or None, **{self.kind: self.file_id})
+
+
+def message_media(message: Message) -> Optional[Tuple[str, str]]:
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.document:
+        return "document", message.document.file_id
+    if message.audio:
+        return "audio", message.audio.file_id
+    return None
+
+
+def build_payload(messages: List[Message]) -> Optional[BroadcastPayload]:
+    if len(messages) > 1:
+        media: List[InputMedia] = []
+        for part in messages:
+            found = message_media(part)
+            if found is None:
+                return None
+            kind, file_id = found
+            media.append(INPUT_MEDIA[kind](media=file_id, caption=(part.caption or "").strip() or None))
+        return BroadcastPayload(kind="album", media=media)
+
+    message = messages[0]
+    text = (message.caption or message.text or "").strip()
+    found = message_media(message)
+    if found is not None:
+        kind, file_id = found
+        return BroadcastPayload(kind=kind, text=text, file_id=file_id)
+    if text:
+        return BroadcastPayload(kind="text", text=text)
+    return None
+
+
+def local_media_kind(path: Path) -> str:
+    ext = path.suffix.lower()
+    if ext in PHOTO_EXTS:
+        return "photo"
+    if ext in VIDEO_EXTS:
+        return "video"
+    return "document"
+
+
+async def upload_local_file(bot: Bot, chat_id: int, path: Path) -> Tuple[str, str, bool]:
+    """Возвращает (kind, file_id, из_кэша); файл грузится в чат chat_id только один раз."""
+    stat = path.stat()
+    key = str(path)
+
+    cached = await get_cached_file_id(key, stat.st_size, stat.st_mtime_ns)
+    if cached:
+        kind, file_id = cached
+        return kind, file_id, True
+
+    kind = local_media_kind(path)
+    extra = {"disable_content_type_detection": True} if kind == "document" else {}
+    send = getattr(bot, f"send_{kind}")
+    uploaded = await send(chat_id=chat_id, **{kind: FSInputFile(path)}, **extra)
+
+    # Telegram может сохранить файл другим типом (например, .mov как документ),
+    # а file_id годится только для метода своего типа.
+    found = message_media(uploaded)
+    if found is None:
+        raise RuntimeError(f"Telegram не вернул файл в ответе на загрузку {path.name}")
+    kind, file_id = found
+    await cache_file_id(key, kind, stat.st_size, stat.st_mtime_ns, file_id)
+    return kind, file_id, False
+
+
+_album_parts: Dict[str, List[Message]] = {}
+_album_done: Dict[str, float] = {}
+
+
+async def collect_album(message: Message) -> Optional[List[Message]]:
+    """Части альбома приходят отдельными апдейтами: первая ждёт остальные."""
+    group_id = message.media_group_id
+    if group_id in _album_done:
+        # Опоздавшая часть уже разосланного альбома.
+        return None
+
+    parts = _album_parts.get(group_id)
+    if parts is not None:
+        parts.append(message)
+        return None
+
+    parts = _album_parts[group_id] = [message]
+    collected = 0
+    while collected != len(parts):
+        collected = len(parts)
+        await asyncio.sleep(ALBUM_WAIT)
+    del _album_parts[group_id]
+
+    now = time.monotonic()
+    for done_id, done_at in list(_album_done.items()):
+        if now - done_at > ALBUM_DONE_TTL:
+            del _album_done[done_id]
+    _album_done[group_id] = now
+
+    return sorted(parts, key=lambda m: m.message_id)
+
+
 # -----------------------------
 # Роутеры
 # -----------------------------
@@ -566,6 +896,64 @@ async def finish_form(message: Message, state: FSMContext, sheets: SheetsClient)
         )
 
 
+# -----------------------------
+# Админ: профилирование
+# -----------------------------
+@admin_router.message(Command("profile"))
+async def admin_profile(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    if _profile_lock.locked():
+        await message.answer("⚠️ Профилирование уже запущено, дождитесь результата.")
+        return
+
+    seconds = PROFILE_DEFAULT_SECONDS
+    if command.args:
+        arg = command.args.strip()
+        if not arg.isdigit() or not 1 <= int(arg) <= PROFILE_MAX_SECONDS:
+            await message.answer(
+                f"⚠️ Укажите длительность в секундах от 1 до {PROFILE_MAX_SECONDS}, например: /profile 30"
+            )
+            return
+        seconds = int(arg)
+
+    async with _profile_lock:
+        own_tracemalloc = not tracemalloc.is_tracing()
+        total = seconds * 2 if own_tracemalloc else seconds
+        await message.answer(
+            f"🔬 <b>Профилирование запущено</b>\n\n"
+            f"⏱ Длительность: {total} с\n"
+            f"Результаты придут файлами."
+        )
+
+        stacks = await asyncio.to_thread(
+            sample_thread, threading.get_ident(), seconds, PROFILE_INTERVAL
+        )
+
+        # Память снимаем отдельным окном после CPU-профиля, чтобы накладные
+        # расходы tracemalloc не попадали в сэмплы стеков.
+        if own_tracemalloc:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            try:
+                await asyncio.sleep(seconds)
+                memory = await asyncio.to_thread(tracemalloc_report, seconds)
+            finally:
+                tracemalloc.stop()
+        else:
+            memory = await asyncio.to_thread(tracemalloc_report, None)
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    await message.answer_document(
+        BufferedInputFile(format_folded_stacks(stacks).encode(), filename=f"profile-{stamp}.txt"),
+        caption=profile_summary(stacks, seconds),
+    )
+    await message.answer_document(
+        BufferedInputFile(memory.encode(), filename=f"tracemalloc-{stamp}.txt"),
+        caption="🧠 <b>Снимок tracemalloc</b>",
+    )
+
+
 # -----------------------------
 # Админ: рассылка
 # -----------------------------
@@ -579,31 +967,77 @@ async def admin_broadcast_start(message: Message, state: FSMContext):
         "📢 <b>Режим рассылки</b>\n\n"
         "Отправьте одним сообщением то, что нужно разослать всем пользователям:\n\n"
         "• Текст\n"
-        "• Фото с подписью\n"
-        "• Фото без подписи\n\n"
+        "• Фото или видео с подписью или без\n"
+        "• Документ или аудио\n"
+        "• Альбом из нескольких файлов\n\n"
+        "Файл с сервера: /broadcast_file имя_файла, подпись — со следующей строки.\n\n"
         "Для отмены используйте /cancel",
         reply_markup=ReplyKeyboardRemove(),
     )
 
 
+@admin_router.message(Command("broadcast_file"))
+async def admin_broadcast_file(message: Message, command: CommandObject, state: FSMContext, bot: Bot):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    name, _, caption = (command.args or "").strip().partition("\n")
+    path = (BROADCAST_MEDIA_DIR / name.strip()).resolve()
+    if not name.strip() or BROADCAST_MEDIA_DIR not in path.parents or not path.is_file():
+        await message.answer(
+            f"⚠️ Файл не найден в каталоге <code>{html.escape(str(BROADCAST_MEDIA_DIR))}</code>.\n\n"
+            "Использование: /broadcast_file имя_файла, подпись — со следующей строки."
+        )
+        return
+
+    try:
+        kind, file_id, cached = await upload_local_file(bot, message.chat.id, path)
+    except Exception as e:
+        print(f"✗ Ошибка загрузки файла {path}: {e}")
+        await message.answer(f"❌ Не удалось загрузить файл в Telegram: {html.escape(str(e))}")
+        return
+
+    print(f"✓ Файл {path.name}: {'file_id из кэша' if cached else 'загружен'}")
+    payload = BroadcastPayload(kind=kind, text=caption.strip(), file_id=file_id)
+    await run_broadcast(message, state, bot, payload)
+
+
 @admin_router.message(AdminFlow.waiting_broadcast)
 async def admin_broadcast_send(message: Message, state: FSMContext, bot: Bot):
     if message.from_user.id not in ADMIN_IDS:
         return
 
+    messages = [message]
+    if message.media_group_id:
+        album = await collect_album(message)
+        if album is None:
+            return
+        messages = album
+
+    payload = build_payload(messages)
+    if payload is None:
+        await message.answer(
+            "⚠️ Этот тип сообщения не поддерживается для рассылки.\n\n"
+            "Отправьте текст, фото, видео, документ, аудио или альбом. Для отмены используйте /cancel"
+        )
+        return
+
+    await run_broadcast(message, state, bot, payload)
+
+
+async def run_broadcast(message: Message, state: FSMContext, bot: Bot, payload: BroadcastPayload):
+    # Выходим из режима рассылки до отправки, чтобы сообщения, пришедшие
+    # во время долгой рассылки, не запускали ещё одну.
+    await state.clear()
     user_ids = await all_user_ids()
 
     if not user_ids:
-        await state.clear()
         await message.answer(
             "⚠️ Нет пользователей для рассылки.",
             reply_markup=main_menu_kb()
         )
         return
 
-    text = (message.caption or message.text or "").strip()
-    photo_id = message.photo[-1].file_id if message.photo else None
-
     status_msg = await message.answer(
         f"📤 <b>Начинаю рассылку...</b>\n\n"
         f"👥 Всего пользователей: {len(user_ids)}"
@@ -614,18 +1048,12 @@ async def admin_broadcast_send(message: Message, state: FSMContext, bot: Bot):
 
     for uid in user_ids:
         try:
-            if photo_id:
-                await bot.send_photo(chat_id=uid, photo=photo_id, caption=text or None)
-            else:
-                if not text:
-                    continue
-                await bot.send_message(chat_id=uid, text=text)
+            await payload.send(bot, uid)
             sent += 1
-            await asyncio.sleep(0.035)
+            await asyncio.sleep(BROADCAST_DELAY * payload.weight)
         except Exception:
             failed += 1
 
-    await state.clear()
     await status_msg.edit_text(
         f"✅ <b>Рассылка завершена!</b>\n\n"
         f"📨 Отправлено: {sent}\n"
@@ -638,8 +1066,13 @@ async def admin_broadcast_send(message: Message, state: FSMContext, bot: Bot):
 # Startup
 # -----------------------------
 async def on_startup(dispatcher: Dispatcher, bot: Bot):
+    global _watchdog
     print("=== Запуск бота ===")
 
+    if SLOW_CALLBACK_SECONDS > 0:
+        _watchdog = LoopWatchdog(threshold=SLOW_CALLBACK_SECONDS)
+        _watchdog.start(asyncio.get_running_loop())
+
     await init_db()
     print("✓ База данных инициализирована")
 
@@ -655,6 +1088,11 @@ async def on_startup(dispatcher: Dispatcher, bot: Bot):
     print("=== Бот готов к работе ===\n")
 
 
+async def on_shutdown():
+    if _watchdog is not None:
+        _watchdog.stop()
+
+
 async def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN is empty")
@@ -670,6 +1108,7 @@ async def main():
     dp.include_router(admin_router)
 
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
     await dp.start_polling(bot)
 